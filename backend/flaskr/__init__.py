@@ -1,24 +1,116 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+from sqlalchemy import func, event, literal, or_, delete, all_, cast, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import object_session
+from sqlalchemy.exc import SQLAlchemyError
+from pydantic import ValidationError
+from functools import lru_cache
+import orjson
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
+from schemas import NewQuestion, QuizRequest
 
 QUESTIONS_PER_PAGE = 10
-
-def paginate_questions(request, selections):
+# OFFSET is a postgres bigint, later pages would overflow it
+MAX_PAGE = (2**63 - 1) // QUESTIONS_PER_PAGE
+STREAM_BATCH_SIZE = 1000
+# text search configuration of the idx_questions_fts index in models.py
+SEARCH_CONFIG = 'simple'
+# the fields of Question.format(), questions lists only select these columns
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = [getattr(Question, field) for field in QUESTION_FIELDS]
+
+'''
+json_response(payload)
+    encodes the response body with orjson, every endpoint and error
+    handler answers through it instead of jsonify
+'''
+def json_response(payload):
+  body = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+  return current_app.response_class(body, mimetype='application/json')
+
+'''
+count_questions(selection)
+    SELECT count(*) over the rows of a query, run it with .scalar()
+    or embed it in another query with .scalar_subquery()
+'''
+def count_questions(selection):
+  return db.session.query(func.count()).select_from(selection.order_by(None).subquery())
+
+'''
+stream_questions(selection, batch_size)
+    iterates over a query through a server-side cursor, fetching
+    batch_size rows at a time, for results too big to load at once
+'''
+def stream_questions(selection, batch_size=STREAM_BATCH_SIZE):
+  return selection.yield_per(batch_size)
+
+'''
+paginate_questions(request, selection)
+    fetches the formatted questions of the requested page from a query
+    together with the total number of matching questions, in one round trip
+'''
+def paginate_questions(request, selection):
   page = request.args.get('page', 1, type=int)
+  # pages start at 1, a lower page would become a negative OFFSET
+  if page < 1 or page > MAX_PAGE:
+    abort(400)
   start = (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-  return selections[start:end]
-
+  # the total is a scalar subquery column, the db counts it once apart
+  # from the page, which still stops reading after LIMIT rows
+  total = count_questions(selection).scalar_subquery()
+  rows = (selection.with_entities(*QUESTION_COLUMNS, total)
+          .offset(start).limit(QUESTIONS_PER_PAGE).all())
+  if len(rows) == 0:
+    # past the last page there is no row to read the total from
+    return [], count_questions(selection).scalar()
+  return [dict(zip(QUESTION_FIELDS, row)) for row in rows], rows[0][-1]
+
+'''
+categories cache
+    the categories are read on most requests but hardly ever change,
+    so their {id: type} dict is built once per version. A transaction
+    that wrote to Category bumps the version when it ends, committed or
+    not, and the next read goes back to the db. Bumping at flush time
+    instead would let a read before the commit cache the old rows under
+    the new version.
+'''
+_categories_cache = {'version': 0}
+
+def invalidate_categories(*args):
+  _categories_cache['version'] += 1
+
+def mark_categories_changed(mapper, connection, target):
+  object_session(target).info['categories_changed'] = True
+
+def end_categories_transaction(session, transaction):
+  # only the outermost transaction ends with a commit or a rollback,
+  # this also covers a session closed with its transaction still open
+  if transaction.parent is None and session.info.pop('categories_changed', False):
+    invalidate_categories()
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+  event.listen(Category, event_name, mark_categories_changed)
+
+event.listen(db.session, 'after_transaction_end', end_categories_transaction)
+
+@lru_cache(maxsize=1)
+def load_formatted_categories(version):
+  categories = Category.query.with_entities(Category.id, Category.type).order_by(Category.id).all()
+  return {category.id: category.type for category in categories}
+
+def get_formatted_categories():
+  return load_formatted_categories(_categories_cache['version'])
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
   setup_db(app)
+  # a new app may be bound to another database
+  invalidate_categories()
   
   '''
   Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -41,12 +133,12 @@ def create_app(test_config=None):
   '''
   @app.route('/categories')
   def get_categories():
-    categories = Category.query.order_by(Category.id).all()
-    if categories is None:
+    formatted_categories = get_formatted_categories()
+    # the dict is empty, never None, when there are no categories
+    if not formatted_categories:
       abort(404)
 
-    formatted_categories = {category.id: category.type for category in categories}
-    return jsonify({
+    return json_response({
       'success': True,
       'categories': formatted_categories
     })
@@ -59,22 +151,20 @@ def create_app(test_config=None):
   '''
   @app.route('/questions')
   def get_questions():
-    selections = Question.query.order_by(Question.id).all()
-    categories = Category.query.order_by(Category.id).all()
-    questions = paginate_questions(request, selections)
+    # only the requested page is fetched, the total comes with it
+    selections = Question.query.order_by(Question.id)
+    formatted_questions, total_questions = paginate_questions(request, selections)
 
     # None is self-tpye in python, ! = [], ! = ''
     # here questions could be [], have to be checked
-    if len(questions) == 0 or categories is None:
+    if len(formatted_questions) == 0:
       abort(404)
-    
-    formatted_questions = [question.format() for question in questions]
-    formatted_categories = {category.id: category.type for category in categories}
+    formatted_categories = get_formatted_categories()
 
-    return jsonify({
+    return json_response({
       'success': True,
       'questions': formatted_questions,
-      'total_questions': len(selections),
+      'total_questions': total_questions,
       'categories': formatted_categories
     })
 
@@ -83,20 +173,25 @@ def create_app(test_config=None):
   '''
   @app.route('/questions/<int:question_id>', methods=['DELETE'])
   def delete_question(question_id):
-    question = Question.query.get(question_id)
+    # one DELETE ... RETURNING both removes the question and tells if it existed
+    try:
+      result = db.session.execute(delete(Question.__table__)
+                                  .where(Question.id == question_id)
+                                  .returning(Question.id))
+      deleted = result.fetchone()
+      db.session.commit()
+    except:
+      db.session.rollback()
+      abort(422)
 
     # abort itslef rasie an exception
     # can not be in the try block 
-    if question is None:
-      abort(404)  
-    try:  
-      question.delete()
-      return jsonify({
-        'success': True,
-        'question_id': question_id
-      })
-    except:
-      abort(422)
+    if deleted is None:
+      abort(404)
+    return json_response({
+      'success': True,
+      'question_id': question_id
+    })
 
 
   '''
@@ -106,22 +201,17 @@ def create_app(test_config=None):
   '''
   @app.route('/questions', methods=['POST'])
   def post_question():
-    body = request.get_json()
-    question = body.get('question')
-    answer = body.get('answer')
-    difficulty = body.get('difficulty')
-    category = body.get('category')
-
-    if (question is None or 
-        answer is None or 
-        difficulty is None or 
-        category is None):
-        abort(400)
+    # missing or mistyped fields are rejected in a single validation
+    try:
+      body = NewQuestion.model_validate(request.get_json())
+    except ValidationError:
+      abort(400)
 
     try:
-      new_question = Question(question=question, answer=answer, category=category, difficulty=difficulty)
+      new_question = Question(question=body.question, answer=body.answer,
+                              category=body.category, difficulty=body.difficulty)
       new_question.insert()
-      return jsonify({
+      return json_response({
         'success': True,
         'message': 'Question successfully created!'
     })
@@ -131,8 +221,9 @@ def create_app(test_config=None):
 
   '''
   Create a POST endpoint to get questions based on a search term. 
-  It should return any questions for whom the search term 
-  is a substring of the question. 
+  A single word is matched as a substring of the question, so partial 
+  words are found. Several words return the questions containing all 
+  of them, most relevant first. 
   '''
   @app.route('/questions/search', methods=['POST'])
   def search_question():
@@ -140,14 +231,25 @@ def create_app(test_config=None):
     search_term = body.get('searchTerm')
 
     if search_term:
-      selections = Question.query.filter(Question.question.ilike('%' + search_term + '%')).all()
-      questions = paginate_questions(request, selections)
-      formatted_questions = [question.format() for question in questions]
+      words = search_term.split()
+      if len(words) == 1:
+        # substring match, served by the trigram index once the term has
+        # 3 or more characters, shorter terms have no trigram to look up
+        # % and _ typed by the user are searched for literally
+        escaped_term = words[0].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        selections = Question.query.filter(Question.question.ilike('%' + escaped_term + '%', escape='\\'))
+        ordering = (Question.id,)
+      else:
+        document = func.to_tsvector(SEARCH_CONFIG, Question.question)
+        query = func.plainto_tsquery(SEARCH_CONFIG, search_term)
+        selections = Question.query.filter(document.op('@@')(query))
+        ordering = (func.ts_rank_cd(document, query).desc(), Question.id)
+      formatted_questions, total_questions = paginate_questions(request, selections.order_by(*ordering))
 
-      return jsonify({
+      return json_response({
         'success': True,
         'questions': formatted_questions,
-        'total_questions': len(selections),
+        'total_questions': total_questions,
       })
     else:
       abort(400)
@@ -158,29 +260,21 @@ def create_app(test_config=None):
   '''
   @app.route('/categories/<int:catetory_id>/questions', methods=['GET'])
   def select_categoty(catetory_id):
-    category = Category.query.get(catetory_id)
+    category = db.session.get(Category, catetory_id)
     if category is None:
       abort(404)
     
-    selections = Question.query.filter_by(category=catetory_id).all()
-    questions = paginate_questions(request, selections)
-    formatted_questions = [question.format() for question in questions]
+    selections = Question.query.filter_by(category=catetory_id)
+    formatted_questions, total_questions = paginate_questions(request, selections.order_by(Question.id))
 
-    return jsonify({
+    return json_response({
       'success': True,
       'questions': formatted_questions,
-      'total_questions': len(selections),
+      'total_questions': total_questions,
       'current_category': catetory_id
     })
 
 
-  '''
-  produce a random int in [left, right)
-  '''
-  def random_number(left, right):
-    return int((right - left) * random.random() + left)
-  
-
   '''
   Create a POST endpoint to get questions to play the quiz. 
   This endpoint should take category and previous question parameters 
@@ -190,26 +284,32 @@ def create_app(test_config=None):
   @app.route('/quizzes', methods=['POST'])
   def next_question():
     try:
-      body = request.get_json()
-      previous_questions = body.get('previous_questions')
-      quiz_category_id = body.get('quiz_category').get('id')
-      
-      if quiz_category_id == 0:
-        selections = Question.query
-      else:
-        selections = Question.query.filter_by(category=quiz_category_id)
+      body = QuizRequest.model_validate(request.get_json())
+    except ValidationError:
+      abort(400)
+    previous_questions = body.previous_questions
+    quiz_category_id = body.quiz_category.id
 
-      questions = selections.filter(Question.id.notin_(previous_questions)).all()
-    except:
+    # one statement filters, excludes and picks the random question, so
+    # only that row comes back. category 0 means all categories and the
+    # previous questions are one array parameter, so the statement is the
+    # same for every quiz and its compiled form is cached once
+    try:
+      row = (Question.query
+             .with_entities(*QUESTION_COLUMNS)
+             .filter(or_(literal(quiz_category_id) == 0,
+                         Question.category == quiz_category_id))
+             .filter(Question.id != all_(cast(previous_questions, ARRAY(Integer))))
+             .order_by(func.random())
+             .first())
+    except SQLAlchemyError:
       abort(422)
-    if len(questions) == 0:
+    if row is None:
       abort(404)
     else:
-      randam_index = random_number(0,len(questions))
-      question = questions[randam_index]
-      return jsonify({
+      return json_response({
         'success': True,
-        'question': question.format()
+        'question': dict(zip(QUESTION_FIELDS, row))
       })
 
 
@@ -220,7 +320,7 @@ def create_app(test_config=None):
 
   @app.errorhandler(400)
   def not_found(error):
-    return jsonify({
+    return json_response({
       'success': False,
       'error': 400,
       'message': 'Bad request.'
@@ -229,7 +329,7 @@ def create_app(test_config=None):
 
   @app.errorhandler(404)
   def not_found(error):
-    return jsonify({
+    return json_response({
       'success': False,
       'error': 404,
       'message': 'Resource not found.'
@@ -237,7 +337,7 @@ def create_app(test_config=None):
   
   @app.errorhandler(422)
   def unprocessable_entity(error):
-    return jsonify({
+    return json_response({
       'success': False,
       'error': 422,
       'message': 'Request was unprocessable.'
@@ -1,10 +1,13 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, Index, DDL, create_engine, event, func
 from flask_sqlalchemy import SQLAlchemy
 import json
 
 database_name = "trivia"
-database_path = "postgres://{}/{}".format('localhost:5432', database_name)
+database_path = "postgresql://{}/{}".format('localhost:5432', database_name)
+
+# compiled SQL is cached per statement shape, keep room for every query the api builds
+query_cache_size = 1200
 
 db = SQLAlchemy()
 
@@ -15,6 +18,7 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {'query_cache_size': query_cache_size}
     db.app = app
     db.init_app(app)
     db.create_all()
@@ -32,6 +36,17 @@ class Question(db.Model):
   category = Column(String)
   difficulty = Column(Integer)
 
+  __table_args__ = (
+    # trigram index so ILIKE '%term%' searches don't scan the whole table
+    Index('idx_questions_question_trgm', 'question',
+          postgresql_using='gin', postgresql_ops={'question': 'gin_trgm_ops'}),
+    # full-text index, the search has to use the same 'simple' configuration
+    Index('idx_questions_fts', func.to_tsvector('simple', question),
+          postgresql_using='gin'),
+    # questions are filtered by category for the category list and the quiz
+    Index('idx_questions_category', 'category'),
+  )
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
@@ -58,6 +73,9 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+event.listen(Question.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 '''
 Category
 
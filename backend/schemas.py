@@ -0,0 +1,30 @@
+from typing import List
+from pydantic import BaseModel, conint
+
+# ids and scores are stored in postgres integer columns
+DbInt = conint(ge=0, le=2**31 - 1)
+
+'''
+NewQuestion
+    body of POST /questions
+'''
+class NewQuestion(BaseModel):
+  question: str
+  answer: str
+  category: DbInt
+  difficulty: DbInt
+
+'''
+QuizCategory
+    category of a quiz, id 0 means all categories
+'''
+class QuizCategory(BaseModel):
+  id: DbInt
+
+'''
+QuizRequest
+    body of POST /quizzes
+'''
+class QuizRequest(BaseModel):
+  previous_questions: List[DbInt]
+  quiz_category: QuizCategory
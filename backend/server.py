@@ -0,0 +1,23 @@
+'''
+server.py
+    serves the api with gevent, so requests waiting on postgres
+    don't block each other. Run from the backend folder:
+        python server.py
+'''
+# patch the standard library and psycopg2 before anything opens a socket
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from gevent.pywsgi import WSGIServer
+
+from flaskr import create_app
+
+# same address as `flask run`, the frontend proxies to it
+HOST = '127.0.0.1'
+PORT = 5000
+
+if __name__ == '__main__':
+  WSGIServer((HOST, PORT), create_app()).serve_forever()
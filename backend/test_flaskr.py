@@ -2,9 +2,10 @@ import os
 import unittest
 import json
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, stream_questions
+from models import setup_db, db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -15,7 +16,7 @@ class TriviaTestCase(unittest.TestCase):
         self.app = create_app()
         self.client = self.app.test_client
         self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
+        self.database_path = "postgresql://{}/{}".format('localhost:5432', self.database_name)
         setup_db(self.app, self.database_path)
         
         self.new_question = {
@@ -44,6 +45,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_get_categories_includes_new_category(self):
+        # fill the categories cache before the write
+        self.client().get('/categories')
+        category = Category(type='Music')
+        db.session.add(category)
+        db.session.commit()
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        db.session.delete(category)
+        db.session.commit()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Music', data['categories'].values())
+
+    def test_get_categories_ignores_rolled_back_category(self):
+        category = Category(type='Music')
+        db.session.add(category)
+        db.session.flush()
+        # read between the flush and the rollback
+        self.client().get('/categories')
+        db.session.rollback()
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Music', data['categories'].values())
 
     def test_404_categories_request_not_allowed(self):
         # res = self.client().get('/categories?page=2')
@@ -65,6 +92,47 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['categories']))
     
+    def test_get_questions_second_page(self):
+        first_page = json.loads(self.client().get('/questions?page=1').data)
+        res = self.client().get('/questions?page=2')
+        data = json.loads(res.data)
+        first_ids = {question['id'] for question in first_page['questions']}
+        second_ids = {question['id'] for question in data['questions']}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertFalse(first_ids & second_ids)
+    
+    def test_400_questions_page_zero(self):
+        res = self.client().get('/questions?page=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request.')
+
+    def test_400_select_category_negative_page(self):
+        res = self.client().get('/categories/1/questions?page=-1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request.')
+    
+    def test_400_questions_page_too_large(self):
+        for path in ('/questions', '/categories/1/questions'):
+            res = self.client().get(path + '?page=99999999999999999999')
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'Bad request.')
+
+        res = self.client().post('/questions/search?page=99999999999999999999', json={'searchTerm': 'a'})
+        self.assertEqual(res.status_code, 400)
+    
     def test_404_questions_beyond_valid_page(self):
         res = self.client().get('/questions?page=1000')
         data = json.loads(res.data)
@@ -80,7 +148,7 @@ class TriviaTestCase(unittest.TestCase):
         res = self.client().delete(f'/questions/{question_id}')
         data = json.loads(res.data)
         # recheck in the db the question has been deleted
-        question_not_exsited = Question.query.get(question_id)
+        question_not_exsited = db.session.get(Question, question_id)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
@@ -130,6 +198,57 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertTrue(data['total_questions'])
     
+    def test_search_question_matches_words(self):
+        search = {'searchTerm': 'soccer world cup'}
+        res = self.client().post('/questions/search', json=search)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertTrue(all('World Cup' in question['question'] for question in data['questions']))
+
+    def test_search_question_matches_partial_word(self):
+        search = {'searchTerm': 'penicil'}
+        res = self.client().post('/questions/search', json=search)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['question'], 'Who discovered penicillin?')
+
+    def test_search_question_ignores_partial_words(self):
+        search = {'searchTerm': 'cup world soccerless'}
+        res = self.client().post('/questions/search', json=search)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 0)
+        self.assertEqual(data['questions'], [])
+    
+    def test_search_question_wildcard_is_literal(self):
+        search = {'searchTerm': '%'}
+        res = self.client().post('/questions/search', json=search)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 0)
+    
+    def test_stream_questions_uses_server_side_cursor(self):
+        selection = Question.query.with_entities(Question.id).order_by(Question.id)
+        rows = iter(stream_questions(selection, batch_size=5))
+        first_row = next(rows)
+        # pg_cursors lists the cursors declared on the current connection
+        open_cursors = db.session.execute(text('SELECT count(*) FROM pg_cursors')).scalar()
+        streamed_ids = [first_row.id] + [row.id for row in rows]
+        db.session.rollback()
+
+        self.assertEqual(open_cursors, 1)
+        self.assertEqual(streamed_ids, [row.id for row in selection.all()])
+
     def test_400_search_question_searchterm_empty(self):
         search = {'searchTerm': ''}
         res = self.client().post('/questions/search', json=search)
@@ -180,6 +299,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question'])
     
+    def test_next_question_all_categories(self):
+        # only one question is left, and category 0 has to find it in category 2
+        remaining = Question.query.filter_by(category=2).first()
+        selections = Question.query.with_entities(Question.id).filter(Question.id != remaining.id).all()
+        quiz_data = {
+            'previous_questions': [row.id for row in selections],
+            'quiz_category': {'type': 'click', 'id': 0}
+        }
+        res = self.client().post('/quizzes', json=quiz_data)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], remaining.id)
+    
     def test_404_next_question_quiz_category_invalid(self):
         quiz_data = {
             'previous_questions': [],
@@ -192,10 +326,34 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource not found.')
     
+    def test_400_next_question_invalid_payload(self):
+        quiz_data = {
+            'previous_questions': ['not an id'],
+            'quiz_category': {'type': None, 'id': 1}
+        }
+        res = self.client().post('/quizzes', json=quiz_data)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request.')
+    
+    def test_400_next_question_id_out_of_range(self):
+        quiz_data = {
+            'previous_questions': [99999999999],
+            'quiz_category': {'type': None, 'id': 1}
+        }
+        res = self.client().post('/quizzes', json=quiz_data)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request.')
+    
     def test_404_next_question_not_exist(self):
         category_id = 1
-        selections = Question.query.filter_by(category=category_id).all()
-        previous_questions = [question.id for question in selections]
+        selections = Question.query.with_entities(Question.id).filter_by(category=category_id).all()
+        previous_questions = [row.id for row in selections]
 
         quiz_data = {
             'previous_questions': previous_questions,